@@ -1,165 +1,293 @@
 #!/usr/bin/env python3
 import collections
 import itertools
+import mmap
+import os
 import random
+import struct
 
+import numpy as np
 import requests
 
 
 URL_PREFIX = 'http://www.sfelections.org/results/20180605/data/'
+CACHE_DIR = os.path.expanduser('~/.cache/sf-votes')
 
 
 def _get_file(rept, name):
-    url = f'{URL_PREFIX}{rept}/{rept}_{name}.txt'
-    return requests.get(url).text
+    """Returns the path to a local copy of the given results file.
 
+    Files are downloaded the first time they're needed, and cached under
+    CACHE_DIR thereafter.
+    """
+    url = f'{URL_PREFIX}{rept}/{rept}_{name}.txt'
+    path = os.path.join(CACHE_DIR, url.split('://', 1)[1])
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with requests.get(url, stream=True) as r:
+            r.raise_for_status()
+            with open(path + '.part', 'wb') as f:
+                for chunk in r.iter_content(64 * 1024):
+                    f.write(chunk)
+        os.replace(path + '.part', path)
+    return path
+
+
+# Fixed-width ballotimage record: contest id, voter id, (serial number,
+# tally type,) precinct id, vote rank, candidate id, overvote, undervote.
+_BALLOTIMAGE_RECORD = struct.Struct('7s9s10x7s3s7scc')
+_RANKS = {b'001': 0, b'002': 1, b'003': 2}
+
+# Raw rankings that aren't candidate indices.
+NO_VOTE = -1
+OVERVOTE = -2
+
+# votes is an int16 array with a row per ballot of its effective rankings
+# (see cleaned_votes), as indices into candidates padded with NO_VOTE;
+# precincts holds each ballot's numeric precinct id, and precinct_names
+# maps those ids to names.  patterns and weights are the distinct rows of
+# votes and their counts (see _patterns), which the algorithms tally.
+Ballots = collections.namedtuple(
+    'Ballots', ['votes', 'precincts', 'candidates', 'precinct_names',
+                'patterns', 'weights'])
+
+
+def _read_ballotimage(ballotimage, contest_id, cand_index):
+    """Returns raw (votes, precincts) arrays for contest_id's ballots.
+
+    Records are fixed-width, so we unpack them in place from the buffer
+    rather than splitting it into lines.
+    """
+    if len(ballotimage) < _BALLOTIMAGE_RECORD.size:
+        offsets = []
+    else:
+        # A file with no newline holds a single record.
+        record_length = ballotimage.find(b'\n') + 1 or len(ballotimage)
+        n_records = ((len(ballotimage) - _BALLOTIMAGE_RECORD.size)
+                     // record_length + 1)
+        # Find this contest's records in one vectorized comparison, by
+        # viewing the leading contest id of each record as an array.
+        contest_ids = np.ndarray((n_records,), f'S{len(contest_id)}',
+                                 buffer=ballotimage, strides=(record_length,))
+        offsets = (np.flatnonzero(contest_ids == contest_id)
+                   * record_length).tolist()
+        del contest_ids  # An mmap can't be closed while this views it.
+
+    # There are at most as many ballots as records; we trim it at the end.
+    votes = np.full((len(offsets), 3), NO_VOTE, np.int16)
+    precincts = np.zeros(len(offsets), np.int32)
+    rows = {}
+    for offset in offsets:
+        _, voter, precinct, rank, candidate, over, under = (
+            _BALLOTIMAGE_RECORD.unpack_from(ballotimage, offset))
+        row = rows.setdefault(voter, len(rows))
+        precincts[row] = int(precinct)
+        if over == b'1':
+            votes[row, _RANKS[rank]] = OVERVOTE
+        elif under != b'1':
+            votes[row, _RANKS[rank]] = cand_index[candidate]
+
+    return votes[:len(rows)], precincts[:len(rows)]
 
-class Ballot:
-    def __init__(self):
-        self.votes = [None, None, None]
 
-    def add_ballotimage_line(self, line, candidates, precincts):
-        self.precinct = precincts[line[26:33]]
-        rank = int(line[33:36].lstrip('0')) - 1
-        if line[43] == '1':
-            self.votes[rank] = 'OVER'
-        elif line[44] == '1':
-            self.votes[rank] = None
+def get_ballots(rept, contest_id='0000020'):  # mayor
+    """Returns a Ballots of the ballots cast in the given contest."""
+    contest_id = contest_id.encode()
+    candidates = []
+    cand_index = {}
+    precinct_names = {}
+    with open(_get_file(rept, 'masterlookup'), 'rb') as masterlookup:
+        for line in masterlookup:
+            if line.startswith(b'Candidate ') and line[74:81] == contest_id:
+                cand_index[line[10:17]] = len(candidates)
+                candidates.append(line[17:67].strip().decode())
+            elif line.startswith(b'Precinct '):
+                precinct_names[int(line[10:17])] = line[17:67].strip().decode()
+
+    with open(_get_file(rept, 'ballotimage'), 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0,
+                           access=mmap.ACCESS_READ) as ballotimage:
+                votes, precincts = _read_ballotimage(
+                    ballotimage, contest_id, cand_index)
         else:
-            self.votes[rank] = candidates[line[36:43]]
+            # mmap can't map an empty file.
+            votes, precincts = _read_ballotimage(b'', contest_id, cand_index)
 
-    def cleaned_votes(self):
-        votes = []
-        for v in self.votes:
-            if v == 'OVER':
-                break
-            elif v and v not in votes:
-                votes.append(v)
-        return votes
+    votes = cleaned_votes(votes)
+    return Ballots(votes, precincts, candidates, precinct_names,
+                   *_patterns(votes, len(candidates)))
 
 
-def get_ballots(rept, contest_id='0000020'):  # mayor
-    """Returns list of ballots."""
-    candidates = {}
-    precincts = {}
-    masterlookup = _get_file(rept, 'masterlookup')
-    for line in masterlookup.splitlines():
-        if line[:10].strip() == 'Candidate' and line[74:81] == contest_id:
-            candidates[line[10:17]] = line[17:67].strip()
-        elif line[:10].strip() == 'Precinct':
-            precincts[line[10:17]] = line[17:67].strip()
-
-    ballots = collections.defaultdict(Ballot)
-    ballotimage = _get_file(rept, 'ballotimage')
-    for line in ballotimage.splitlines():
-        if line[:7] == contest_id:
-            ballots[line[7:16]].add_ballotimage_line(
-                line, candidates, precincts)
-
-    return list(ballots.values())
+def cleaned_votes(votes):
+    """Returns the effective rankings of each ballot in raw votes.
+
+    Rankings after an overvote, undervotes, and repeat rankings of the same
+    candidate are dropped; the remaining choices of each ballot are moved to
+    the front of its row, padded with NO_VOTE.
+    """
+    valid = np.minimum.accumulate(votes != OVERVOTE, axis=1)
+    valid &= votes >= 0
+    for i in range(1, votes.shape[1]):
+        valid[:, i] &= (votes[:, :i] != votes[:, [i]]).all(axis=1)
+
+    order = np.argsort(~valid, axis=1, kind='stable')
+    return np.where(np.take_along_axis(valid, order, axis=1),
+                    np.take_along_axis(votes, order, axis=1), NO_VOTE)
+
+
+def _pattern_codes(votes, k):
+    """Returns an int64 per row of votes, ordered as the rows are.
+
+    k is the number of candidates.
+    """
+    codes = np.zeros(len(votes), np.int64)
+    for column in votes.T:
+        codes = codes * (k + 1) + column + 1
+    return codes
+
+
+def _patterns(votes, k):
+    """Returns (patterns, weights) for votes over k candidates.
+
+    patterns holds the distinct rows of votes, in sorted order, and weights
+    the number of ballots with each; there are far fewer of these than
+    ballots.
+    """
+    _, first, weights = np.unique(_pattern_codes(votes, k),
+                                  return_index=True, return_counts=True)
+    return votes[first], weights
+
+
+def _to_eliminate(totals):
+    """Returns the candidates to eliminate, given (candidate, votes) totals.
+
+    totals is sorted from most to fewest votes.
+
+    This is the largest set of last-place candidates whose combined votes
+    are fewer than those of the next-lowest candidate: none of them can
+    catch up, so eliminating them together gives the same result as
+    eliminating them one at a time.
+    """
+    ascending = totals[::-1]
+    n = 1
+    running = 0
+    for i, (_, v) in enumerate(ascending[:-1]):
+        running += v
+        if running < ascending[i + 1][1]:
+            n = i + 1
+    return [c for c, _ in ascending[:n]]
+
+
+def _top_choices(patterns, alive):
+    """Returns each pattern's highest-ranked candidate still alive.
+
+    Exhausted patterns get NO_VOTE.
+    """
+    live = (patterns >= 0) & alive[np.maximum(patterns, 0)]
+    first = patterns[np.arange(len(patterns)), live.argmax(axis=1)]
+    return np.where(live.any(axis=1), first, NO_VOTE)
 
 
 def run_irv(ballots, verbose=True):
-    votes = [b.cleaned_votes() for b in ballots]
+    candidates = ballots.candidates
+    patterns, weights = ballots.patterns, ballots.weights
+    # Candidates with no first-choice votes can never win, so drop them
+    # before the first round.
+    alive = np.zeros(len(candidates), bool)
+    alive[patterns[patterns[:, 0] >= 0, 0]] = True
+    top = _top_choices(patterns, alive)
     for i in itertools.count(1):
-        nonexhausted = len(list(filter(None, votes)))
-        totals = collections.Counter(
-            v[0] for v in votes if v).most_common()
+        nonexhausted = weights[top >= 0].sum()
+        tally = np.bincount(top[top >= 0], weights=weights[top >= 0],
+                            minlength=len(candidates)).astype(np.int64)
+        totals = [(c, tally[c])
+                  for c in np.argsort(-tally, kind='stable') if alive[c]]
 
         if verbose:
             print("---------- ROUND %s (%s ballots) ----------"
                   % (i, nonexhausted))
             for c, v in totals:
-                print(("%s:" % c).ljust(25), "%6s" % v)
+                print(("%s:" % candidates[c]).ljust(25), "%6s" % v)
 
         c, v = totals[0]
         if v > nonexhausted / 2:
             if verbose:
-                print("Winner: %s (%s votes)" % (c, v))
-            return c
+                print("Winner: %s (%s votes)" % (candidates[c], v))
+            return candidates[c]
 
+        eliminated = _to_eliminate(totals)
+        alive[eliminated] = False
+        moved = np.isin(top, eliminated)
+        top[moved] = _top_choices(patterns[moved], alive)
         if verbose:
-            eliminated = totals[-1][0]
-            nexts = collections.Counter(
-                v[1] if len(v) >= 2 else None
-                for v in votes if v and v[0] == eliminated).most_common()
+            # Shifted by one so that exhausted ballots are counted in nexts[0].
+            nexts = np.bincount(top[moved] + 1, weights=weights[moved],
+                                minlength=len(candidates) + 1).astype(np.int64)
             print()
-            print("%s eliminated!" % eliminated)
-            for c, v in nexts:
-                if c:
-                    print("%6s -> %s" % (v, c))
+            print("%s eliminated!"
+                  % ", ".join(candidates[c] for c in eliminated))
+            for c in np.argsort(-nexts, kind='stable'):
+                if not nexts[c]:
+                    break
+                elif c:
+                    print("%6s -> %s" % (nexts[c], candidates[c - 1]))
                 else:
-                    print("%6s exhausted" % v)
-
-        for v in votes:
-            while eliminated in v:
-                v.remove(eliminated)
+                    print("%6s exhausted" % nexts[c])
 
 
 def pairwise_preferences(ballots):
-    candidates = set()
-    votes = [b.cleaned_votes() for b in ballots]
-    for v in votes:
-        candidates.update(v)
+    """Returns (prefs, candidates).
+
+    prefs[i, j] is the number of voters preferring candidates[i] to
+    candidates[j]; a ranked candidate is preferred to any unranked one.
+    """
+    ranked, weights = ballots.patterns, ballots.weights
+    k = len(ballots.candidates)
 
-    prefs = {}
-    for a in candidates:
-        for b in candidates:
-            if a != b:
-                prefs[(a, b)] = 0
+    prefs = np.zeros((k, k), np.int64)
+    for i, j in itertools.combinations(range(3), 2):
+        # Cleaned rankings are distinct and packed to the front, so if the
+        # later rank is filled in, so is the earlier one.
+        mask = ranked[:, j] >= 0
+        np.add.at(prefs, (ranked[mask, i], ranked[mask, j]), weights[mask])
 
-    for v in votes:
-        for i, c in enumerate(v):
-            for d in v[i + 1:]:
-                prefs[(c, d)] += 1
-            for d in candidates - set(v):
-                prefs[(c, d)] += 1
+    # Each candidate on a ballot also beats everyone absent from it, so
+    # summed over ballots that's a product of the presence matrix with its
+    # complement.
+    rows, cols = np.nonzero(ranked >= 0)
+    present = np.zeros((len(ranked), k), bool)
+    present[rows, ranked[rows, cols]] = True
+    prefs += (present * weights[:, np.newaxis]).T @ ~present
 
-    return prefs
+    return prefs, ballots.candidates
 
 
 def run_condorcet(ballots, verbose=True, pref_fn=pairwise_preferences):
-    prefs = pref_fn(ballots)
-    candidates = {c for c, _ in prefs}
-    wins = {c: len([c for d in candidates
-                    if c != d and prefs[(c, d)] > prefs[(d, c)]])
-            for c in candidates}
+    prefs, candidates = pref_fn(ballots)
+    wins = (prefs > prefs.T).sum(axis=1)
 
     if verbose:
         print("Ordering (best to worst):")
-        for i in range(len(candidates) - 1, -1, -1):
-            cs = [c for c, w in wins.items() if w == i]
+        for w in np.unique(wins)[::-1]:
+            cs = [candidates[i] for i in np.flatnonzero(wins == w)]
             if len(cs) > 1:
                 print(", ".join(cs), "(tie)")
-            elif cs:
+            else:
                 print(cs[0])
 
-    for c, w in wins.items():
-        if w == len(candidates) - 1:
-            return c
+    for i in np.flatnonzero(wins == len(candidates) - 1):
+        return candidates[i]
 
 
 def _strongest_paths(ballots):
-    prefs = pairwise_preferences(ballots)
-    candidates = {c for c, _ in prefs}
-    paths = {}
-    for c in candidates:
-        for d in candidates:
-            if c != d:
-                if prefs[(c, d)] > prefs[(d, c)]:
-                    paths[(c, d)] = prefs[(c, d)]
-                else:
-                    paths[(c, d)] = 0
-
-    for c in candidates:
-        for d in candidates:
-            if c != d:
-                for e in candidates:
-                    if e not in (c, d):
-                        paths[(d, e)] = max(paths[(d, e)],
-                                            min(paths[(d, c)], paths[(c, e)]))
-
-    return paths
+    prefs, candidates = pairwise_preferences(ballots)
+    paths = np.where(prefs > prefs.T, prefs, 0)
+    for c in range(len(candidates)):
+        np.maximum(paths, np.minimum(paths[:, c, np.newaxis], paths[c]),
+                   out=paths)
+    np.fill_diagonal(paths, 0)
+    return paths, candidates
 
 
 def run_schulze(ballots, verbose=True):
@@ -167,12 +295,16 @@ def run_schulze(ballots, verbose=True):
 
 
 def run_borda(ballots, verbose=True, count_fn=lambda i: 3 - i):
-    counts = collections.defaultdict(int)
-    for b in ballots:
-        for i, v in enumerate(b.cleaned_votes()):
-            counts[v] += count_fn(i)
-
-    winners = sorted(counts.items(), key=lambda i: i[1], reverse=True)
+    k = len(ballots.candidates)
+    counts = np.zeros(k, np.int64)
+    for i, column in enumerate(ballots.patterns.T):
+        valid = column >= 0
+        counts += count_fn(i) * np.bincount(
+            column[valid], weights=ballots.weights[valid],
+            minlength=k).astype(np.int64)
+
+    winners = sorted(zip(ballots.candidates, counts.tolist()),
+                     key=lambda i: i[1], reverse=True)
     if verbose:
         print("Borda counts:")
         for c, v in winners:
@@ -190,7 +322,18 @@ def run_approval(ballots, verbose=True, cutoff=3):
 
 
 def add_votes(ballots, candidate, n):
-    ballots_for_candidate = [b for b in ballots
-                             if b.cleaned_votes()
-                             and b.cleaned_votes()[0] == candidate]
-    return ballots + random.sample(ballots_for_candidate, n)
+    rows = np.flatnonzero(
+        ballots.votes[:, 0] == ballots.candidates.index(candidate))
+    extra = random.sample(rows.tolist(), n)
+    # The added ballots copy existing ones, so their patterns are already
+    # present and only need their weights bumped.
+    k = len(ballots.candidates)
+    weights = ballots.weights.copy()
+    np.add.at(weights,
+              np.searchsorted(_pattern_codes(ballots.patterns, k),
+                              _pattern_codes(ballots.votes[extra], k)), 1)
+    return ballots._replace(
+        votes=np.concatenate([ballots.votes, ballots.votes[extra]]),
+        precincts=np.concatenate([ballots.precincts,
+                                  ballots.precincts[extra]]),
+        weights=weights)